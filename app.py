@@ -1,9 +1,12 @@
-from flask import Flask, request, jsonify
-import os, psycopg2, psycopg2.extras
+from flask import Flask, request, send_from_directory
+import os, orjson, queue, select, threading, time, psycopg2
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from datetime import datetime, timedelta, timezone
 
+import db
+
 app = Flask(__name__)
-DB_URL = os.getenv('DATABASE_URL')
 
 SAFE_WINDOWS = {
     '24h': '24 hours',
@@ -15,130 +18,313 @@ SAFE_INTERVALS = {
     '1h': '1 hour',
     '1d': '1 day'
 }
+# Charts stay readable (and cheap to ship and draw) well below this
+MAX_POINTS_DEFAULT = 500
+MAX_POINTS_LIMIT = 10000
+# The three dashboard charts, served together by /api/offset/all
+DASHBOARD_CHARTS = {
+    'd24': ('24h', '5min'),
+    'd14': ('14d', '1h'),
+    'd90': ('90d', '1d')
+}
+# Runs per-chart queries side by side on pooled connections (see db.py)
+fanout = ThreadPoolExecutor(max_workers=db.DB_POOL_MAX, thread_name_prefix='offset')
+# Postgres NOTIFY channel -> SSE event name (see postgres/schema.sql)
+STREAM_EVENTS = {
+    'ntp_new': 'latest',
+    'ntp_offset_refreshed': 'offset'
+}
+STREAM_HEARTBEAT_SEC = 15
+# Each open stream pins a gthread worker thread; past this many per worker,
+# /api/stream answers 503 and the page polls instead, leaving threads for the API.
+STREAM_MAX_CLIENTS = int(os.getenv('STREAM_MAX_CLIENTS', '4'))
+stream_slots = threading.BoundedSemaphore(STREAM_MAX_CLIENTS)
 
-def q(sql, args=()):
-    with psycopg2.connect(DB_URL) as conn:
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-            cur.execute(sql, args)
+def q(sql, args=(), prepared=None):
+    """
+    Run `sql` and fetch all rows. With `prepared`, `sql` uses $n placeholders
+    and is kept as a per-connection prepared statement of that name.
+    """
+    with db.connection() as conn:
+        with conn.cursor() as cur:
+            if prepared:
+                db.execute_prepared(cur, prepared, sql, args)
+            else:
+                cur.execute(sql, args)
             return cur.fetchall()
 
-def aggregate_offset(window_human: str, interval_human: str):
-    rows = q(f"""
-        SELECT date_bin(%s::interval, ts, '2000-01-01'::timestamptz) AS bucket,
-               avg(last_offset_sec) AS avg_offset,
-               percentile_cont(0.95) WITHIN GROUP (ORDER BY abs(last_offset_sec)) AS p95_abs_offset,
-               max(abs(last_offset_sec)) AS max_abs_offset
-        FROM metrics.ntp_parent
-        WHERE ts >= now() - %s::interval
-        GROUP BY bucket
-        ORDER BY bucket;
-    """, (interval_human, window_human))
-    return [{"ts": r["bucket"].isoformat(),
-             "avg": r["avg_offset"],
-             "p95": r["p95_abs_offset"],
-             "max": r["max_abs_offset"]}
-            for r in rows]
+def json_response(payload, status: int = 200):
+    # orjson serializes datetimes natively and is several times faster than jsonify;
+    # bytes are taken as already-serialized JSON
+    body = payload if isinstance(payload, bytes) else orjson.dumps(payload)
+    return app.response_class(body, status=status, mimetype='application/json')
+
+def conditional(tag: str, build):
+    """
+    Answer 304 when the browser already holds `tag`; otherwise call `build()`
+    for the full response. Either way the (weak) ETag is attached.
+    """
+    if request.if_none_match.contains_weak(tag):
+        resp = app.response_class(status=304)
+    else:
+        resp = build()
+    resp.set_etag(tag, weak=True)
+    resp.cache_control.max_age = 5
+    return resp
+
+def offset_etag(window: str, interval: str, max_points: int) -> str:
+    # Last rollup refresh plus bucket count in the window: changes whenever
+    # pg_cron refreshes the view or an old bucket slides out.
+    refreshed, count = q("""
+        SELECT (SELECT refreshed_at FROM metrics.ntp_offset_refresh), count(*)
+        FROM metrics.ntp_offset_buckets
+        WHERE width = $1::interval AND bucket >= now() - $2::interval
+    """, (SAFE_INTERVALS[interval], SAFE_WINDOWS[window]), prepared='offset_etag_q')[0]
+    stamp = refreshed.isoformat() if refreshed else 'empty'
+    return f"{stamp}-{count}-{window}-{interval}-{max_points}"
+
+def lttb(xs, ys, n_out: int) -> list[int]:
+    """
+    Largest-Triangle-Three-Buckets downsampling: indices of `n_out` points
+    that best preserve the visual shape of (xs, ys). Endpoints are always kept.
+    """
+    n = len(xs)
+    if n_out >= n or n_out < 3:
+        return list(range(n))
+    every = (n - 2) / (n_out - 2)
+    keep, a = [0], 0
+    for i in range(n_out - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        nxt_end = min(int((i + 2) * every) + 1, n)
+        # Third triangle vertex: centroid of the next bucket
+        span = max(nxt_end - end, 1)
+        cx = sum(xs[end:nxt_end]) / span
+        cy = sum(ys[end:nxt_end]) / span
+        ax, ay = xs[a], ys[a]
+        best, best_area = start, -1.0
+        for j in range(start, end):
+            area = abs((ax - cx) * (ys[j] - ay) - (ax - xs[j]) * (cy - ay))
+            if area > best_area:
+                best, best_area = j, area
+        keep.append(best)
+        a = best
+    keep.append(n - 1)
+    return keep
+
+def aggregate_offset(window_human: str, interval_human: str, max_points: int = MAX_POINTS_DEFAULT):
+    # Pre-bucketed by metrics.ntp_offset_buckets (see postgres/schema.sql)
+    rows = q("""
+        SELECT bucket, avg_offset, p95_abs_offset, max_abs_offset
+        FROM metrics.ntp_offset_buckets
+        WHERE width = $1::interval AND bucket >= now() - $2::interval
+        ORDER BY bucket
+    """, (interval_human, window_human), prepared='offset_q')
+    if len(rows) > max_points:
+        # Pick buckets by the avg series; p95/max ride along at the same indices
+        xs = [r[0].timestamp() for r in rows]
+        ys = [r[1] or 0.0 for r in rows]
+        rows = [rows[i] for i in lttb(xs, ys, max_points)]
+    # Columnar payload: one array per series, which is what Plotly consumes.
+    # zip(*rows) transposes in C into exactly-sized tuples (no per-row Python
+    # loop, no list growth); orjson writes tuples as JSON arrays.
+    ts, avg, p95, mx = zip(*rows) if rows else ((), (), (), ())
+    return {"ts": ts, "avg": avg, "p95": p95, "max": mx}
+
+def aggregate_offset_json(window_human: str, interval_human: str, max_points: int) -> bytes | None:
+    """
+    Same columnar payload as aggregate_offset(), built by Postgres with
+    json_agg and cast to text so psycopg2 hands it back unparsed. Returns None
+    when the window holds more than `max_points` buckets and needs LTTB.
+    """
+    rows = q("""
+        SELECT json_build_object(
+                 'ts',  coalesce(json_agg(to_char(bucket AT TIME ZONE 'UTC',
+                                                  'YYYY-MM-DD"T"HH24:MI:SS"+00:00"') ORDER BY bucket), '[]'),
+                 'avg', coalesce(json_agg(avg_offset ORDER BY bucket), '[]'),
+                 'p95', coalesce(json_agg(p95_abs_offset ORDER BY bucket), '[]'),
+                 'max', coalesce(json_agg(max_abs_offset ORDER BY bucket), '[]')
+               )::text
+        FROM metrics.ntp_offset_buckets
+        WHERE width = $1::interval AND bucket >= now() - $2::interval
+        HAVING count(*) <= $3
+    """, (interval_human, window_human, max_points), prepared='offset_json_q')
+    return rows[0][0].encode() if rows else None
+
+@lru_cache(maxsize=64)
+def offset_json(window: str, interval: str, max_points: int, tag: str) -> bytes:
+    """
+    Serialized offset payload for one chart, shared by every client of this
+    worker. Keyed by the chart's current ETag: new data means a new tag, so an
+    entry is never served stale and old ones simply age out of the LRU.
+    """
+    window_human, interval_human = SAFE_WINDOWS[window], SAFE_INTERVALS[interval]
+    body = aggregate_offset_json(window_human, interval_human, max_points)
+    if body is None:
+        # Too many buckets: fetch rows and downsample in Python
+        body = orjson.dumps(aggregate_offset(window_human, interval_human, max_points))
+    return body
+
+def for_each_chart(fn) -> dict:
+    """Call fn(window, interval) for every dashboard chart concurrently."""
+    futures = {key: fanout.submit(fn, window, interval)
+               for key, (window, interval) in DASHBOARD_CHARTS.items()}
+    return {key: f.result() for key, f in futures.items()}
+
+def max_points_arg() -> int | None:
+    """The max_points query parameter, or None when it is not an integer in range."""
+    raw = request.args.get("max_points")
+    if raw is None:
+        return MAX_POINTS_DEFAULT
+    try:
+        value = int(raw)
+    except ValueError:
+        return None
+    return value if 3 <= value <= MAX_POINTS_LIMIT else None
 
 @app.get("/api/offset")
 def api_offset():
     window = request.args.get("window", "24h")
     interval = request.args.get("interval", "5min")
-    if window not in SAFE_WINDOWS or interval not in SAFE_INTERVALS:
-        return jsonify({"error":"bad params"}), 400
-    data = aggregate_offset(SAFE_WINDOWS[window], SAFE_INTERVALS[interval])
-    return jsonify(data)
+    max_points = max_points_arg()
+    if window not in SAFE_WINDOWS or interval not in SAFE_INTERVALS or max_points is None:
+        return json_response({"error":"bad params"}, 400)
+    tag = offset_etag(window, interval, max_points)
+    return conditional(tag, lambda: json_response(offset_json(window, interval, max_points, tag)))
 
-@app.get("/api/latest")
-def api_latest():
+@app.get("/api/offset/all")
+def api_offset_all():
+    max_points = max_points_arg()
+    if max_points is None:
+        return json_response({"error":"bad params"}, 400)
+    tags = for_each_chart(lambda w, i: offset_etag(w, i, max_points))
+    tag_of = {DASHBOARD_CHARTS[key]: tag for key, tag in tags.items()}
+
+    def build():
+        parts = for_each_chart(lambda w, i: offset_json(w, i, max_points, tag_of[(w, i)]))
+        return json_response(b'{' + b','.join(b'"%s":%s' % (key.encode(), body)
+                                              for key, body in parts.items()) + b'}')
+
+    return conditional('|'.join(tags[key] for key in DASHBOARD_CHARTS), build)
+
+def latest_response():
     rows = q("""
         SELECT ts, last_offset_sec, stratum, total_sources, leap_status, gps_mode
         FROM metrics.ntp_parent
         ORDER BY ts DESC
-        LIMIT 1;
-    """)
-    if not rows: return jsonify({})
-    r = rows[0]
-    return jsonify({
-        "ts": r["ts"].isoformat(),
-        "offset": r["last_offset_sec"],
-        "stratum": r["stratum"],
-        "total_sources": r["total_sources"],
-        "leap_status": r["leap_status"],
-        "gps_mode": r["gps_mode"]
+        LIMIT 1
+    """, prepared='latest_q')
+    if not rows: return json_response({})
+    ts, offset, stratum, total_sources, leap_status, gps_mode = rows[0]
+    return json_response({
+        "ts": ts,
+        "offset": offset,
+        "stratum": stratum,
+        "total_sources": total_sources,
+        "leap_status": leap_status,
+        "gps_mode": gps_mode
     })
 
+@app.get("/api/latest")
+def api_latest():
+    newest = q("SELECT max(ts) FROM metrics.ntp_parent", prepared='latest_etag_q')[0][0]
+    tag = newest.isoformat() if newest else 'empty'
+    return conditional(tag, latest_response)
+
+# One LISTEN connection per worker process fans notifications out to every
+# open /api/stream response through a per-client queue.
+subscribers: set[queue.Queue] = set()
+subscribers_lock = threading.Lock()
+listener = None
+
+def publish(event: str, data: str) -> None:
+    with subscribers_lock:
+        targets = list(subscribers)
+    for sub in targets:
+        try:
+            sub.put_nowait((event, data))
+        except queue.Full:
+            pass  # client is not reading; it resyncs on its next "offset" event
+
+def listen_forever() -> None:
+    reconnect = False
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(db.DB_URL)
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                for channel in STREAM_EVENTS:
+                    cur.execute(f'LISTEN {channel};')
+            # Anything sent while we were reconnecting is lost: have clients resync.
+            # Not on the first connect; nothing was missed and clients just drew.
+            if reconnect:
+                publish('offset', 'resync')
+            reconnect = True
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    n = conn.notifies.pop(0)
+                    publish(STREAM_EVENTS[n.channel], n.payload)
+        except psycopg2.Error as e:
+            app.logger.warning(f'LISTEN connection failed: {e}; retrying in 5s')
+            time.sleep(5)
+        finally:
+            if conn is not None:
+                conn.close()
+
+def ensure_listener() -> None:
+    global listener
+    with subscribers_lock:
+        if listener is None or not listener.is_alive():
+            listener = threading.Thread(target=listen_forever, name='pg-listen', daemon=True)
+            listener.start()
+
+@app.get("/api/stream")
+def api_stream():
+    if not stream_slots.acquire(blocking=False):
+        # EventSource gives up on a non-200 answer; the page falls back to polling
+        return app.response_class('too many streams\n', status=503, mimetype='text/plain',
+                                  headers={'Retry-After': '30'})
+    ensure_listener()
+    sub = queue.Queue(maxsize=100)
+    with subscribers_lock:
+        subscribers.add(sub)
+
+    def events():
+        yield 'retry: 5000\n\n'
+        while True:
+            try:
+                event, data = sub.get(timeout=STREAM_HEARTBEAT_SEC)
+            except queue.Empty:
+                yield ': keepalive\n\n'  # keeps proxies from timing out idle streams
+                continue
+            yield f'event: {event}\ndata: {data}\n\n'
+
+    def close() -> None:
+        with subscribers_lock:
+            subscribers.discard(sub)
+        stream_slots.release()
+
+    resp = app.response_class(events(), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Runs when the server closes the response, even if the generator never started
+    resp.call_on_close(close)
+    return resp
+
 @app.get("/")
 def index():
-    return """
-<!doctype html><html><head>
-<meta charset=utf-8><meta name=viewport content="width=device-width,initial-scale=1">
-<title>NTP/GPS Dashboard</title>
-<script src="https://cdn.plot.ly/plotly-2.32.0.min.js"></script>
-<style>
-  body{font-family:system-ui,Segoe UI,Roboto,Helvetica,Arial,sans-serif;background:#0b1220;color:#e5e7eb;margin:0}
-  header{padding:16px 24px;border-bottom:1px solid #111;background:#0e1626}
-  .wrap{padding:18px 24px}
-  .grid{display:grid;grid-template-columns:1fr;gap:16px}
-  .card{background:#111827;border:1px solid #1f2937;border-radius:16px;padding:16px}
-  .row{display:grid;grid-template-columns:repeat(3,minmax(0,1fr));gap:16px}
-  .pill{display:inline-block;padding:6px 10px;border-radius:999px;font-weight:600}
-  .ok{background:#064e3b;color:#d1fae5}
-  .bad{background:#7f1d1d;color:#fecaca}
-  h2{margin:0 0 12px 0;font-size:18px}
-</style>
-</head><body>
-<header><h1>NTP/GPS Dashboard</h1></header>
-<div class=wrap>
-  <div class="card">
-    <div class="row">
-      <div>Stratum: <span id=stratum style="font-weight:700;font-size:20px"></span></div>
-      <div>Leap: <span id=leap class=pill></span></div>
-      <div>GPS: <span id=gps class=pill></span></div>
-    </div>
-  </div>
-  <div class="grid">
-    <div class="card"><h2>Offset last 24h (5-min buckets)</h2><div id=chart24h></div></div>
-    <div class="card"><h2>Offset last 14d (hourly buckets)</h2><div id=chart14d></div></div>
-    <div class="card"><h2>Offset last 90d (daily buckets)</h2><div id=chart90d></div></div>
-  </div>
-</div>
-<script>
-async function fetchJSON(u){ const r = await fetch(u); return r.json(); }
-function plot(id,data,title){
-  const x = data.map(d=>d.ts);
-  const avg = data.map(d=>d.avg);
-  const p95 = data.map(d=>d.p95);
-  const max = data.map(d=>d.max);
-  const traces = [
-    {x, y: avg, name:'avg offset', mode:'lines'},
-    {x, y: p95, name:'p95 abs offset', mode:'lines'},
-    {x, y: max, name:'max abs offset', mode:'lines'}
-  ];
-  Plotly.newPlot(id, traces, {margin:{l:40,r:10,t:10,b:40}, legend:{orientation:'h'}}, {displayModeBar:false, staticPlot:true});
-}
-async function draw(){
-  const latest = await fetchJSON('/api/latest');
-  document.getElementById('stratum').textContent = latest.stratum ?? '—';
-
-  const leap = document.getElementById('leap');
-  leap.textContent = latest.leap_status || 'Unknown';
-  leap.className = 'pill ' + (latest.leap_status==='Normal' ? 'ok' : 'bad');
-
-  const gps = document.getElementById('gps');
-  const gm = (latest.gps_mode||'').toLowerCase();
-  gps.textContent = latest.gps_mode || 'Unknown';
-  gps.className = 'pill ' + ((gm.includes('2d')||gm.includes('3d')) ? 'ok' : 'bad');
-
-  const d24 = await fetchJSON('/api/offset?window=24h&interval=5min');
-  const d14 = await fetchJSON('/api/offset?window=14d&interval=1h');
-  const d90 = await fetchJSON('/api/offset?window=90d&interval=1d');
-  plot('chart24h', d24, '24h');
-  plot('chart14d', d14, '14d');
-  plot('chart90d', d90, '90d');
-}
-draw(); setInterval(draw, 30000);
-</script>
-</body></html>
-"""
-if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=int(os.getenv("DASH_PORT","8080")))
+    # The page is static; Dockerfile.dashboard ships a gzip -9 copy next to it
+    gz = os.path.join(app.static_folder, 'index.html.gz')
+    # Quality check, not membership: "gzip;q=0" means the client refuses it
+    if request.accept_encodings['gzip'] > 0 and os.path.exists(gz):
+        resp = send_from_directory(app.static_folder, 'index.html.gz', mimetype='text/html',
+                                   download_name='index.html', max_age=3600)
+        resp.headers['Content-Encoding'] = 'gzip'
+    else:
+        resp = send_from_directory(app.static_folder, 'index.html', max_age=3600)
+    resp.vary.add('Accept-Encoding')
+    resp.cache_control.public = True
+    return resp
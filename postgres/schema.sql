@@ -14,8 +14,24 @@ CREATE TABLE IF NOT EXISTS metrics.ntp_parent (
   PRIMARY KEY (ts)
 ) PARTITION BY RANGE (ts);
 
--- Helpful for pruning/queries
-CREATE INDEX IF NOT EXISTS idx_ntp_ts ON metrics.ntp_parent (ts);
+-- The primary key already gives every partition a btree on ts. It serves the
+-- window range scans, max(ts), and ORDER BY ts DESC LIMIT 1 (backward scan),
+-- so a second ts index only doubles write and vacuum cost. Drop the copies
+-- that older versions of this file created (safe if they don't exist).
+DROP INDEX IF EXISTS metrics.idx_ntp_ts;
+
+DO $$
+DECLARE
+  r RECORD;
+BEGIN
+  FOR r IN
+    SELECT schemaname, indexname FROM pg_indexes
+    WHERE schemaname = 'metrics'
+      AND indexname ~ '^ntp_y[0-9]{4}m[0-9]{2}d[0-9]{2}_ts_idx$'
+  LOOP
+    EXECUTE format('DROP INDEX IF EXISTS %I.%I;', r.schemaname, r.indexname);
+  END LOOP;
+END$$;
 
 -- 2) Drop any old versions (safe if they don't exist)
 DO $$
@@ -49,7 +65,6 @@ DECLARE
   parent_name  text := 'ntp_parent';
   part_name    text := format('ntp_y%sm%sd%s',
                      to_char(p_day,'YYYY'), to_char(p_day,'MM'), to_char(p_day,'DD'));
-  idx_name     text := part_name || '_ts_idx';
   child_reg    regclass;
 BEGIN
   -- Create the partition table only if it does not already exist
@@ -61,12 +76,7 @@ BEGIN
       schema_name, part_name, schema_name, parent_name, part_start, part_end
     );
   END IF;
-
-  -- Ensure per-child index exists (safe to run repeatedly)
-  EXECUTE format(
-    'CREATE INDEX IF NOT EXISTS %I ON %I.%I (ts);',
-    idx_name, schema_name, part_name
-  );
+  -- No extra index: the partition inherits the primary key's btree on ts
 END;
 $$;
 
@@ -185,3 +195,119 @@ END$$;
 
 -- 7) Optional: run once now (90-day retention, pre-create 1 day ahead)
 SELECT metrics.maintain_partitions(90, 1);
+
+-- =====================================================================
+-- 8) Pre-bucketed offset aggregates for the dashboard
+-- =====================================================================
+-- app.py serves /api/offset from this view instead of re-aggregating raw rows
+-- on every poll. One row per (width, bucket) for each dashboard interval;
+-- pg_cron refreshes it every 5 minutes. Plain Postgres (no TimescaleDB on RDS),
+-- so this is a regular materialized view refreshed CONCURRENTLY.
+-- Dropped and recreated so definition changes take effect on re-run.
+DROP MATERIALIZED VIEW IF EXISTS metrics.ntp_offset_buckets;
+
+CREATE MATERIALIZED VIEW metrics.ntp_offset_buckets AS
+SELECT w.width,
+       date_bin(w.width, p.ts, '2000-01-01'::timestamptz) AS bucket,
+       avg(p.last_offset_sec) AS avg_offset,
+       -- discrete percentile: picks an observed sample, no interpolation step
+       percentile_disc(0.95) WITHIN GROUP (ORDER BY abs(p.last_offset_sec)) AS p95_abs_offset,
+       max(abs(p.last_offset_sec)) AS max_abs_offset
+FROM metrics.ntp_parent p
+CROSS JOIN (VALUES (interval '5 minutes'), (interval '1 hour'), (interval '1 day')) AS w(width)
+GROUP BY w.width, bucket;
+
+-- Required by REFRESH ... CONCURRENTLY; also serves the API's range scans
+CREATE UNIQUE INDEX ntp_offset_buckets_width_bucket
+  ON metrics.ntp_offset_buckets (width, bucket);
+
+-- Single-row marker the dashboard folds into its ETag
+CREATE TABLE IF NOT EXISTS metrics.ntp_offset_refresh (
+  id            boolean PRIMARY KEY DEFAULT true CHECK (id),
+  refreshed_at  timestamptz NOT NULL
+);
+
+INSERT INTO metrics.ntp_offset_refresh (id, refreshed_at) VALUES (true, now())
+ON CONFLICT (id) DO UPDATE SET refreshed_at = EXCLUDED.refreshed_at;
+
+CREATE OR REPLACE FUNCTION metrics.refresh_offset_buckets()
+RETURNS void
+LANGUAGE plpgsql
+SECURITY DEFINER
+AS $$
+BEGIN
+  REFRESH MATERIALIZED VIEW CONCURRENTLY metrics.ntp_offset_buckets;
+  INSERT INTO metrics.ntp_offset_refresh (id, refreshed_at) VALUES (true, now())
+  ON CONFLICT (id) DO UPDATE SET refreshed_at = EXCLUDED.refreshed_at;
+  -- Tell dashboards (app.py /api/stream) to refetch their charts
+  PERFORM pg_notify('ntp_offset_refreshed', now()::text);
+END;
+$$;
+
+-- Create or update the 5-minute refresh job (same pattern as section 6).
+DO $$
+DECLARE
+  v_has_jobname boolean;
+  v_jobid int;
+BEGIN
+  SELECT EXISTS (
+    SELECT 1 FROM information_schema.columns
+    WHERE table_schema = 'cron' AND table_name = 'job' AND column_name = 'jobname'
+  ) INTO v_has_jobname;
+
+  IF v_has_jobname THEN
+    SELECT jobid INTO v_jobid FROM cron.job WHERE jobname = 'metrics_offset_buckets_refresh' LIMIT 1;
+
+    IF v_jobid IS NULL THEN
+      PERFORM cron.schedule('metrics_offset_buckets_refresh', '*/5 * * * *',
+                            'SELECT metrics.refresh_offset_buckets();');
+    ELSE
+      PERFORM cron.alter_job(v_jobid,
+              schedule => '*/5 * * * *',
+              command  => 'SELECT metrics.refresh_offset_buckets();',
+              active   => true);
+    END IF;
+  ELSE
+    -- Fallback for older pg_cron: match by command text
+    SELECT jobid INTO v_jobid
+      FROM cron.job
+     WHERE command = 'SELECT metrics.refresh_offset_buckets();'
+     LIMIT 1;
+
+    IF v_jobid IS NULL THEN
+      PERFORM cron.schedule('*/5 * * * *', 'SELECT metrics.refresh_offset_buckets();');
+    ELSE
+      PERFORM cron.alter_job(v_jobid,
+              schedule => '*/5 * * * *',
+              command  => 'SELECT metrics.refresh_offset_buckets();',
+              active   => true);
+    END IF;
+  END IF;
+END$$;
+
+-- =====================================================================
+-- 9) Push new samples to the dashboard (LISTEN/NOTIFY)
+-- =====================================================================
+-- app.py LISTENs on ntp_new and forwards each payload to browsers over
+-- Server-Sent Events. The payload matches the /api/latest JSON shape.
+CREATE OR REPLACE FUNCTION metrics.notify_ntp_new()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+  PERFORM pg_notify('ntp_new', json_build_object(
+    'ts',            NEW.ts,
+    'offset',        NEW.last_offset_sec,
+    'stratum',       NEW.stratum,
+    'total_sources', NEW.total_sources,
+    'leap_status',   NEW.leap_status,
+    'gps_mode',      NEW.gps_mode
+  )::text);
+  RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS ntp_parent_notify ON metrics.ntp_parent;
+CREATE TRIGGER ntp_parent_notify
+  AFTER INSERT ON metrics.ntp_parent
+  FOR EACH ROW EXECUTE FUNCTION metrics.notify_ntp_new();
@@ -0,0 +1,26 @@
+#!/bin/sh
+# Keep the newest gpsd TPV reports in a small file so ntp-checker's monitor.py
+# can `tail` it (GPS_RING_FILE) instead of starting gpspipe on every check.
+RING="${GPS_RING_FILE:-/run/gps-ring/tpv.jsonl}"
+KEEP="${GPS_RING_LINES:-20}"
+# Publish at most once per FLUSH seconds; keep it well under monitor.py's
+# GPS_RING_MAX_AGE_SEC (default 10)
+FLUSH="${GPS_RING_FLUSH_SEC:-3}"
+TMP="$RING.tmp"
+
+# mawk (Debian/Ubuntu/Raspberry Pi OS default) block-buffers pipe input, so
+# the ring would only move every few KB; -W interactive makes it read by line
+AWK=awk
+if awk -W version 2>&1 | grep -q mawk; then AWK="awk -W interactive"; fi
+
+gpspipe -w | $AWK -v ring="$RING" -v tmp="$TMP" -v keep="$KEEP" -v flush="$FLUSH" '
+  index($0, "\"class\":\"TPV\"") {
+    buf[n++ % keep] = $0
+    srand(); now = srand()  # POSIX: srand() returns the previous (time-of-day) seed
+    if (now - last < flush) next
+    last = now
+    for (i = (n > keep ? n - keep : 0); i < n; i++) print buf[i % keep] > tmp
+    close(tmp)
+    # rename is atomic, so readers never see a half-written file
+    system("mv -f \"" tmp "\" \"" ring "\"")
+  }'